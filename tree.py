@@ -1,10 +1,22 @@
 #!/usr/bin/env python3
-import copy
+import cmath
+import ctypes
 import time
 import random
 import math
 import argparse
-from rpi_ws281x import PixelStrip
+import numpy as np
+from rpi_ws281x import PixelStrip, ws
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional, the plain NumPy renderers are used without it
+    njit = None
+
+try:
+    from tree_kernels import render_rainbow
+except ImportError:  # Cython kernels are optional, build with: cythonize -3 -i tree_kernels.pyx
+    render_rainbow = None
 
 # LED strip configuration:
 LED_COUNT = 100  # Number of LED pixels.
@@ -14,85 +26,145 @@ LED_DMA = 10  # DMA channel to use for generating signal (try 10)
 LED_BRIGHTNESS = 255  # Set to 0 for darkest and 255 for brightest
 LED_INVERT = False  # True to invert the signal (when using NPN transistor level shift)
 LED_CHANNEL = 0  # set to '1' for GPIOs 13, 19, 41, 45 or 53
+FRAME_NS = 40_000_000  # Frame period in nanoseconds (25 fps)
 
+I_LED = np.arange(LED_COUNT)  # LED index, used by the vectorized renderers
 
-class Color:
-    def __init__(self, red=0, green=0, blue=0):
-        self.red = red
-        self.green = green
-        self.blue = blue
-        self.black = self.red == 0 and self.green == 0 and self.blue == 0
-
-    def __iadd__(self, other):
-        if other.black:
-            return self
-        if self.black is False:
-            self.red += other.red
-            self.green += other.green
-            self.blue += other.blue
-        else:
-            self.black = False
-            self.red = other.red
-            self.green = other.green
-            self.blue = other.blue
-        return self
-
-    def __imul__(self, other):
-        if self.black:
-            return self
-        if other < 0:
-            other = 0
-        self.red *= other
-        self.green *= other
-        self.blue *= other
-        return self
-
-    def get(self):
-        if self.black:
-            return 0
-        if self.red > 255:
-            self.red = 255
-        if self.green > 255:
-            self.green = 255
-        if self.blue > 255:
-            self.blue = 255
-        return (round(self.red) << 8) | (round(self.green) << 16) | round(self.blue)
+# Rainbow colors across 0-255 positions, one r, g, b row per position
+_p = np.arange(256)
+WHEEL_LUT = np.stack((
+    np.where(_p < 85, _p * 3, np.where(_p < 170, 255 - (_p - 85) * 3, 0)),
+    np.where(_p < 85, 255 - _p * 3, np.where(_p < 170, 0, (_p - 170) * 3)),
+    np.where(_p < 85, 0, np.where(_p < 170, (_p - 85) * 3, 255 - (_p - 170) * 3)),
+), 1).astype(np.uint8)
+WHEEL_U32 = (WHEEL_LUT[:, 0].astype(np.uint32) << 16) | (WHEEL_LUT[:, 1].astype(np.uint32) << 8) | WHEEL_LUT[:, 2]
+# sin(x) * 0.4 + 0.6 over one turn of x in 256 steps, as 0-255 brightness
+BRIGHT_LUT_U8 = np.rint(np.clip(np.sin(_p * 2 * np.pi / 256) * 0.4 + 0.6, 0, 1) * 255).astype(np.uint8)
+del _p
+PHASE_TURN = 1 << 16  # fixed-point phase units per full turn, the top 8 bits index BRIGHT_LUT_U8
+
+
+def rgb(red, green, blue):
+    """Pack a color into a 0xRRGGBB integer."""
+    return (int(red) << 16) | (int(green) << 8) | int(blue)
+
+
+def cmul(c, m):
+    """Scale packed colors by m/255 (m = 0-255), red and blue in one multiply."""
+    rb = (c & 0x00ff00ff) * m + 0x00800080
+    rb = ((rb + ((rb >> 8) & 0x00ff00ff)) >> 8) & 0x00ff00ff
+    g = (c & 0x0000ff00) * m + 0x00008000
+    g = ((g + ((g >> 8) & 0x0000ff00)) >> 8) & 0x0000ff00
+    return rb | g
+
+
+def cadd(a, b):
+    """Add packed colors, saturating every channel at 255."""
+    rb = (a & 0x00ff00ff) + (b & 0x00ff00ff)
+    g = (a & 0x0000ff00) + (b & 0x0000ff00)
+    rb |= 0x01000100 - ((rb >> 8) & 0x00010001)
+    g |= 0x00010000 - ((g >> 8) & 0x00000100)
+    return (rb & 0x00ff00ff) | (g & 0x0000ff00)
+
+
+def scaled(c, m):
+    """Scale packed colors by brightness m (0-1, lower values give black)."""
+    return cmul(c, np.rint(np.clip(m, 0, 1) * 255).astype(np.uint32))
+
+
+def unpack(c, out=None):
+    """Split packed colors into r, g, b float rows, written to out when given."""
+    if out is None:
+        out = np.empty((3,) + np.shape(c), dtype=np.float32)
+    out[0] = (c >> 16) & 255
+    out[1] = (c >> 8) & 255
+    out[2] = c & 255
+    return out
 
 
 def wheel(pos):
     """Generate rainbow colors across 0-255 positions."""
-    if pos < 85:
-        return Color(pos * 3, 255 - pos * 3, 0)
-    elif pos < 170:
-        pos -= 85
-        return Color(255 - pos * 3, 0, pos * 3)
-    else:
-        pos -= 170
-        return Color(0, pos * 3, 255 - pos * 3)
+    return rgb(*WHEEL_LUT[pos & 255].tolist())
 
 
 def fixcolor(pos):
     if pos == 0:
-        return Color(255, 0, 0)
+        return rgb(255, 0, 0)
     elif pos == 1:
-        return Color(0, 255, 0)
+        return rgb(0, 255, 0)
     elif pos == 2:
-        return Color(0, 0, 255)
+        return rgb(0, 0, 255)
     elif pos == 3:
-        return Color(128, 128, 0)
+        return rgb(128, 128, 0)
     elif pos == 4:
-        return Color(0, 128, 128)
+        return rgb(0, 128, 128)
     elif pos == 5:
-        return Color(128, 0, 128)
-    return Color(255, 255, 255)
+        return rgb(128, 0, 128)
+    return rgb(255, 255, 255)
+
+
+if njit is not None:
+    @njit(cache=True, fastmath=True, nogil=True)
+    def _rainbow_kernel(state, wave_q, pos_q, wheel, bright, out):
+        for i in range(out.shape[1]):
+            k = (state + i) & 255
+            m = np.int64(bright[((i * wave_q + pos_q + 128) >> 8) & 255])
+            for c in range(3):
+                x = wheel[k, c] * m + 128
+                out[c, i] = (x + (x >> 8)) >> 8
+
+    @njit(cache=True, fastmath=True, nogil=True)
+    def _dots_kernel(steps, rot, gain, offset, color, out):
+        for i in range(out.shape[1]):
+            m = (steps[i] * rot).imag * gain + offset
+            if m < 0.1:
+                m = 0.0
+            out[0, i] = color[0] * m
+            out[1, i] = color[1] * m
+            out[2, i] = color[2] * m
+
+    @njit(cache=True, fastmath=True, nogil=True)
+    def _mix_kernel(buf1, buf2, mix):
+        for c in range(3):
+            for i in range(buf1.shape[1]):
+                buf1[c, i] += (buf2[c, i] - buf1[c, i]) * mix
+else:
+    _rainbow_kernel = None
+    _dots_kernel = None
+    _mix_kernel = None
+
+
+def sin_row(steps, rot, out):
+    """sin(i * wave + phase) for every LED, from steps = e^(j * wave * I_LED) and rot = e^(j * phase)."""
+    np.multiply(steps.imag, rot.real, out=out)
+    out += steps.real * rot.imag
+    return out
+
+
+def pack_frame(buf, px, out):
+    """Pack a clamped r, g, b float frame into the strip's (R << 8) | (G << 16) | B layout."""
+    np.copyto(px, buf, casting='unsafe')
+    r, g, b = px
+    np.left_shift(r, 8, out=out)
+    np.left_shift(g, 16, out=g)
+    np.bitwise_or(out, g, out=out)
+    np.bitwise_or(out, b, out=out)
+    return out
+
+
+def blit_frame(strip, packed):
+    """Copy a frame of packed uint32 pixels straight into the strip's LED buffer."""
+    leds = ws.ws2811_channel_t_leds_get(strip._channel)
+    ctypes.memmove(int(leds), packed.ctypes.data, LED_COUNT * 4)
 
 
 class LightFunc:
     def __init__(self):
         self.state = 0
+        self.dirty = True  # whether the next frame differs from the last rendered one
 
-    def get(self, i) -> Color:
-        return Color()
+    def render(self, buf):
+        buf.fill(0)
 
     def next_frame(self):
         self.state += 1
@@ -100,33 +172,39 @@ class LightFunc:
 
 class LightFuncN:
     def __init__(self):
-        self.state = [0] * LED_COUNT
+        self.state = np.zeros(LED_COUNT, dtype=np.int16)
+        self.dirty = True
 
-    def get(self, i) -> Color:
-        return Color()
+    def render(self, buf):
+        buf.fill(0)
 
     def next_frame(self):
-        for i in range(LED_COUNT):
-            if self.state[i]:
-                self.state[i] -= 1
+        self.dirty = bool(self.state.any())
+        self.state -= self.state > 0
 
 
 class FuncRainbow(LightFunc):
     def __init__(self):
         super().__init__()
         self.wave = random.randrange(2, 5) / 10
-        self.pos = 0
         self.shift = random.randrange(20, 100) / 200
-
-    def get(self, i) -> Color:
-        c = wheel((self.state + i) & 255)
-        c *= math.sin(i * self.wave + self.pos) * 0.4 + 0.6
-        return c
+        self.wave_q = round(self.wave * PHASE_TURN / (2 * math.pi))
+        self.shift_q = round(self.shift * PHASE_TURN / (2 * math.pi))
+        self.pos_q = 0
+
+    def render(self, buf):
+        if render_rainbow is not None:
+            render_rainbow(self.state, self.wave_q, self.pos_q, WHEEL_LUT, BRIGHT_LUT_U8, buf)
+        elif _rainbow_kernel is not None:
+            _rainbow_kernel(self.state, self.wave_q, self.pos_q, WHEEL_LUT, BRIGHT_LUT_U8, buf)
+        else:
+            phase = ((I_LED * self.wave_q + self.pos_q + 128) >> 8) & 255
+            unpack(cmul(WHEEL_U32[(I_LED + self.state) & 255], BRIGHT_LUT_U8[phase]), out=buf)
 
     def next_frame(self):
         self.state += 1
         self.state &= 255
-        self.pos += self.shift
+        self.pos_q = (self.pos_q + self.shift_q) % PHASE_TURN
 
 
 class FuncMoveingDots1(LightFunc):
@@ -134,40 +212,55 @@ class FuncMoveingDots1(LightFunc):
         super().__init__()
         self.brighness = brighness
         self.color = wheel(random.randrange(256))
+        self.rgb = unpack(self.color)
+        self.scratch = np.zeros(LED_COUNT)  # per-frame brightness row, reused between frames
         self.wave = random.randrange(2, 5) / 10
         self.shift = random.randrange(-100, 100) / 200 * speed
+        self.steps = np.exp(1j * self.wave * I_LED)
+        self.rot = 1 + 0j
+        self.turn = cmath.exp(1j * self.shift)
 
-    def get(self, i) -> Color:
-        m = math.sin(i * self.wave + self.state) * self.brighness
-        if m < 0.1:
-            c = Color()
+    def render(self, buf):
+        if _dots_kernel is not None:
+            _dots_kernel(self.steps, self.rot, self.brighness, 0.0, self.rgb, buf)
         else:
-            c = copy.copy(self.color)
-            c *= m
-        return c
+            m = sin_row(self.steps, self.rot, self.scratch)
+            m *= self.brighness
+            m[m < 0.1] = 0
+            np.multiply.outer(self.rgb, m, out=buf)
 
     def next_frame(self):
-        self.state += self.shift
+        self.dirty = self.shift != 0
+        self.rot *= self.turn
+        self.rot /= abs(self.rot)
 
 
 class FuncMoveingDots2(LightFunc):
     def __init__(self):
         super().__init__()
         self.color = wheel(random.randrange(256))
+        self.rgb = unpack(self.color)
+        self.scratch = np.zeros(LED_COUNT)  # per-frame brightness row, reused between frames
         self.wave = 2 * math.pi * (random.randrange(3) + 1) / LED_COUNT
         self.speed = random.randrange(-100, 100) / 200
+        self.steps = np.exp(1j * self.wave * I_LED)
+        self.rot = 1 + 0j
+        self.turn = cmath.exp(1j * self.speed)
 
-    def get(self, i) -> Color:
-        m = math.sin(i * self.wave + self.state) * 4 - 3
-        if m < 0.1:
-            c = Color()
+    def render(self, buf):
+        if _dots_kernel is not None:
+            _dots_kernel(self.steps, self.rot, 4.0, -3.0, self.rgb, buf)
         else:
-            c = copy.copy(self.color)
-            c *= m
-        return c
+            m = sin_row(self.steps, self.rot, self.scratch)
+            m *= 4
+            m -= 3
+            m[m < 0.1] = 0
+            np.multiply.outer(self.rgb, m, out=buf)
 
     def next_frame(self):
-        self.state += self.speed
+        self.dirty = self.speed != 0
+        self.rot *= self.turn
+        self.rot /= abs(self.rot)
 
 
 class FuncMoveCombine(LightFunc):
@@ -175,15 +268,17 @@ class FuncMoveCombine(LightFunc):
         super().__init__()
         self.f1 = FuncMoveingDots1(0.2, 0.1)
         self.f2 = FuncMoveingDots2()
+        self.tmp = np.zeros((3, LED_COUNT), dtype=np.float32)  # f2 output, added onto f1's
 
-    def get(self, i) -> Color:
-        c = self.f1.get(i)
-        c += self.f2.get(i)
-        return c
+    def render(self, buf):
+        self.f1.render(buf)
+        self.f2.render(self.tmp)
+        np.add(buf, self.tmp, out=buf)
 
     def next_frame(self):
         self.f1.next_frame()
         self.f2.next_frame()
+        self.dirty = self.f1.dirty or self.f2.dirty
 
 
 class FuncRGBSinWave(LightFunc):
@@ -197,14 +292,13 @@ class FuncRGBSinWave(LightFunc):
             self.speed.append(random.randrange(-100, 100) / 500)
             self.pos.append(random.randrange(-314, 314) / 100)
 
-    def get(self, i) -> Color:
-        c = []
-        for ci in range(3):
-            c.append(3 ** (math.sin(i * self.wave[ci] + self.pos[ci]) * 5 - 5) * 255)
-        r, g, b = c
-        return Color(r, g, b)
+    def render(self, buf):
+        wave = np.array(self.wave)[:, None]
+        pos = np.array(self.pos)[:, None]
+        buf[:] = 3 ** (np.sin(I_LED * wave + pos) * 5 - 5) * 255
 
     def next_frame(self):
+        self.dirty = any(self.speed)
         for i in range(3):
             self.pos[i] += self.speed[i]
 
@@ -220,15 +314,14 @@ class FuncRGBSawWave(LightFunc):
             self.speed.append(random.randrange(-100, 100) / 4000)
             self.pos.append(random.randrange(100) / 100)
             
-    def get(self, i) -> Color:
-        c = []
-        for ci in range(3):
-            y = i * self.wave[ci] + self.pos[ci]
-            c.append(3 ** ((y - math.floor(y)) * 5 - 5) * 255)
-        r, g, b = c
-        return Color(r, g, b)
+    def render(self, buf):
+        wave = np.array(self.wave)[:, None]
+        pos = np.array(self.pos)[:, None]
+        y = I_LED * wave + pos
+        buf[:] = 3 ** ((y - np.floor(y)) * 5 - 5) * 255
 
     def next_frame(self):
+        self.dirty = any(self.speed)
         for i in range(3):
             self.pos[i] += self.speed[i]
 
@@ -238,16 +331,10 @@ class FuncFade1(LightFuncN):
         super().__init__()
         self.color = wheel(random.randrange(256))
 
-    def get(self, i) -> Color:
-        s = self.state[i]
-        if s == 0:
-            return Color()
-        ret = copy.copy(self.color)
-        if s < 20:
-            ret *= s / 20
-        else:
-            ret *= (25 - s) / 5
-        return ret
+    def render(self, buf):
+        s = self.state
+        m = np.where(s < 20, s / 20, (25 - s) / 5)
+        unpack(scaled(self.color, m), out=buf)
 
     def next_frame(self):
         super().next_frame()
@@ -255,6 +342,7 @@ class FuncFade1(LightFuncN):
             i = random.randrange(LED_COUNT)
             if self.state[i] == 0:
                 self.state[i] = 24
+                self.dirty = True
 
 
 class FuncFade2(LightFuncN):
@@ -264,35 +352,20 @@ class FuncFade2(LightFuncN):
         self.slow = 50
         self.slow2 = self.slow * 2
         self.color1 = wheel(random.randrange(256))
-        self.color2 = fixcolor(random.randrange(7))
-        self.color2 *= 0.08
-        for i in range(LED_COUNT):
-            self.state[i] = random.randrange(self.slow * 2)
-
-    def get(self, i) -> Color:
-        s = self.state[i]
-        ret = copy.copy(self.color2)
-        if s <= self.slow2:
-            if s < self.slow:
-                ret *= (self.slow - s) / self.slow
-            else:
-                ret *= (s - self.slow) / self.slow
-            return ret
-        chigh = copy.copy(self.color1)
-        if s < self.slow2 + self.fast:
-            chigh *= (s - self.slow2) / self.fast
-            ret += chigh
-        else:
-            chigh *= (self.slow2 + self.fast + 5 - s) / 5
-            return chigh
-        return ret
+        self.color2 = cmul(fixcolor(random.randrange(7)), 20)
+        self.state[:] = random.choices(range(self.slow2), k=LED_COUNT)
+
+    def render(self, buf):
+        s, slow, slow2, fast = self.state, self.slow, self.slow2, self.fast
+        low = s <= slow2
+        rising = s < slow2 + fast
+        m2 = np.where(low, np.abs(s - slow) / slow, np.where(rising, 1, 0))
+        m1 = np.where(low, 0, np.where(rising, (s - slow2) / fast, (slow2 + fast + 5 - s) / 5))
+        unpack(cadd(scaled(self.color2, m2), scaled(self.color1, m1)), out=buf)
 
     def next_frame(self):
-        for i in range(LED_COUNT):
-            if self.state[i]:
-                self.state[i] -= 1
-            else:
-                self.state[i] = self.slow2
+        self.state -= 1
+        self.state[self.state < 0] = self.slow2
         if random.randrange(10) == 0:
             i = random.randrange(LED_COUNT)
             if self.state[i] <= self.slow2:
@@ -305,30 +378,19 @@ class FuncSparkling1(LightFuncN):
         self.slow = 50
         self.slow2 = self.slow * 2
         self.color1 = wheel(random.randrange(256))
-        self.color2 = fixcolor(random.randrange(7))
-        self.color2 *= 0.08
-        for i in range(LED_COUNT):
-            self.state[i] = random.randrange(self.slow * 2)
-
-    def get(self, i) -> Color:
-        s = self.state[i]
-        if random.randrange(LED_COUNT * 10) == 0:
-            ret = copy.copy(self.color1)
-        else:
-            ret = copy.copy(self.color2)
-            if s <= self.slow2:
-                if s < self.slow:
-                    ret *= (self.slow - s) / self.slow
-                else:
-                    ret *= (s - self.slow) / self.slow
-        return ret
+        self.color2 = cmul(fixcolor(random.randrange(7)), 20)
+        self.sparkle = np.zeros(LED_COUNT, dtype=bool)  # LEDs flashing color1 this frame
+        self.state[:] = random.choices(range(self.slow2), k=LED_COUNT)
+
+    def render(self, buf):
+        s, slow = self.state, self.slow
+        m = np.where(s <= self.slow2, np.abs(s - slow) / slow, 1)
+        unpack(np.where(self.sparkle, self.color1, scaled(self.color2, m)), out=buf)
 
     def next_frame(self):
-        for i in range(LED_COUNT):
-            if self.state[i]:
-                self.state[i] -= 1
-            else:
-                self.state[i] = self.slow2
+        self.state -= 1
+        self.state[self.state < 0] = self.slow2
+        self.sparkle = np.random.randint(0, LED_COUNT * 10, LED_COUNT) == 0
 
 
 class Tree:
@@ -338,7 +400,11 @@ class Tree:
         self.strip.begin()
         self.func1 = None  # typing.Optional[LightFunc, LightFuncN]
         self.func2 = None  # typing.Optional[LightFunc, LightFuncN]
-        self.mix = 0
+        self.mix = 0.0
+        self.buf1 = np.zeros((3, LED_COUNT), dtype=np.float32)  # r, g, b rows of the frame
+        self.buf2 = np.zeros((3, LED_COUNT), dtype=np.float32)  # func2 output while cross-fading
+        self.px = np.zeros((3, LED_COUNT), dtype=np.uint32)  # integer r, g, b rows for packing
+        self.packed = np.zeros(LED_COUNT, dtype=np.uint32)  # frame in the strip's pixel layout
         self.funclist = [FuncRainbow, FuncMoveingDots1, FuncMoveingDots2, FuncMoveCombine, FuncRGBSinWave,
                          FuncRGBSawWave, FuncFade1, FuncFade2, FuncSparkling1]
         self.fixfunc = None
@@ -356,54 +422,58 @@ class Tree:
 
     def run(self):
         self.func1 = self._random_func()
-        t = time.time()
-        t_next_scene = t + self.args.wait
-        t_next = t + 0.04
+        t = time.monotonic_ns()
+        t_next_scene = t + self.args.wait * 1_000_000_000
+        t_next = t + FRAME_NS
         t_fps = t
         fps = 0
+        buf1, buf2, px, packed, strip = self.buf1, self.buf2, self.px, self.packed, self.strip
+        monotonic_ns, sleep = time.monotonic_ns, time.sleep
         try:
             while True:
-                for i in range(LED_COUNT):
-                    c = self.func1.get(i)
+                if self.func2 is not None or self.func1.dirty:
+                    self.func1.render(buf1)
                     if self.func2 is not None:
-                        c *= (1 - self.mix)
-                        c2 = self.func2.get(i)
-                        c2 *= self.mix
-                        c += c2
-                    try:
-                        self.strip.setPixelColor(i, c.get())
-                    except OverflowError:
-                        print(c)
-                        print(c.get())
-                self.strip.show()
+                        self.func2.render(buf2)
+                        if _mix_kernel is not None:
+                            _mix_kernel(buf1, buf2, self.mix)
+                        else:
+                            buf2 -= buf1
+                            buf2 *= self.mix
+                            buf1 += buf2
+                    assert buf1.min() >= 0, buf1
+                    np.minimum(buf1, 255.0, out=buf1)
+                    np.rint(buf1, out=buf1)
+                    pack_frame(buf1, px, packed)
+                    blit_frame(strip, packed)
+                    strip.show()
                 self.func1.next_frame()
-                t = time.time()
+                t = monotonic_ns()
                 if self.func2 is None:
                     if t_next_scene < t:
                         self.func2 = self._random_func()
-                        self.mix = 0
+                        self.mix = 0.0
                 else:
                     self.mix += 0.02
                     if self.mix >= 1:
                         self.func1 = self.func2
+                        self.func1.dirty = True
                         self.func2 = None
-                        t_next_scene = t + self.args.wait
+                        t_next_scene = t + self.args.wait * 1_000_000_000
                     else:
                         self.func2.next_frame()
                 if self.args.fps:
                     fps += 1
-                    if t_fps + 1 <= t:
-                        t_fps += 1
+                    if t_fps + 1_000_000_000 <= t:
+                        t_fps += 1_000_000_000
                         print(f"FPS: {fps}")
                         fps = 0
-                t = time.time()
-                w = t_next - t
-                if w >= 0.01:
-                    t_next += 0.04
-                else:
-                    w = 0.01
-                    t_next = t + 0.05
-                time.sleep(w)
+                w = t_next - monotonic_ns()
+                if w > 0:
+                    sleep(w * 1e-9)
+                elif w < -FRAME_NS:  # more than a frame behind, resync instead of rushing
+                    t_next -= w
+                t_next += FRAME_NS
         except KeyboardInterrupt:
             pass
         if self.args.clear:
@@ -0,0 +1,23 @@
+# cython: language_level=3
+"""Compiled frame kernels for tree.py.
+
+Build in place with: cythonize -3 -i tree_kernels.pyx
+tree.py falls back to Numba or NumPy when the module is not built.
+"""
+cimport cython
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef void render_rainbow(long state, long wave_q, long pos_q, const unsigned char[:, ::1] wheel,
+                          const unsigned char[::1] bright, float[:, ::1] out):
+    """FuncRainbow frame: wheel colors scaled by the fixed-point sine brightness, written to out."""
+    cdef Py_ssize_t i, c
+    cdef long k, m, x
+    with nogil:
+        for i in range(out.shape[1]):
+            k = (state + i) & 255
+            m = bright[((i * wave_q + pos_q + 128) >> 8) & 255]
+            for c in range(3):
+                x = wheel[k, c] * m + 128
+                out[c, i] = (x + (x >> 8)) >> 8